@@ -1,46 +1,128 @@
-from fastapi import FastAPI, Query, Response, Header, HTTPException, Request, File, UploadFile, Form, Body
+from fastapi import FastAPI, Query, Response, Header, HTTPException, Request, File, UploadFile, Form
 from pydantic import BaseModel
+from enum import Enum
 import qrcode
+from qrcode.image.svg import SvgImage
 import io
 from typing import Optional, List
-from fastapi.responses import StreamingResponse, JSONResponse
-import base64
-from fastapi.exception_handlers import RequestValidationError
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
+import pybase64
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import PlainTextResponse
 from fastapi import status
 import zipfile
-from PIL import Image
+import hashlib
+import tempfile
+import time
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image, ImageColor
+import cv2
+import numpy as np
+import simplejpeg
 import segno
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import sys
 import os
-import platform
 from pathlib import Path
-import datetime
 from fastapi.middleware.cors import CORSMiddleware
 
 # Define the data directory
 data_dir = Path("/data")
 log_dir = data_dir / "logs"
+cache_dir = data_dir / "cache"
+
+# Rendered GET /generate images are kept on disk, trimmed back to this size periodically
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DISK_CACHE_TRIM_INTERVAL = 300  # seconds
+
+# How often the background health check renders a test QR code
+QR_CHECK_INTERVAL = 30  # seconds
 
 # Configure logging
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.StreamHandler(sys.stdout),
+    logging.FileHandler(log_dir / "app.log", mode='a')
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+# Request handlers only enqueue records; a background thread formats them and does the I/O
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(log_dir / "app.log", mode='a')
-    ]
+    level=logging.INFO,
+    format='%(message)s',  # the listener's handlers apply the full format
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
 
 logger = logging.getLogger(__name__)
 
+# QR rendering is CPU-bound, so it runs in worker processes to keep the event loop free
+executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+class RenderCache:
+    """LRU cache of rendered payloads, bounded by entry count and by total payload bytes"""
+
+    def __init__(self, maxsize: int, max_bytes: int, max_item_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.currbytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size: int):
+        if size > self.max_item_bytes:
+            return  # large payloads would push out many small ones
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.currbytes -= previous[1]
+        self._entries[key] = (value, size)
+        self.currbytes += size
+        while len(self._entries) > self.maxsize or self.currbytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.currbytes -= evicted_size
+            self.evictions += 1
+
+    def cache_info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "maxsize": self.maxsize,
+            "currsize": len(self._entries),
+            "max_bytes": self.max_bytes,
+            "currbytes": self.currbytes,
+        }
+
+# Rendered payloads are kept in the API process so all render workers share them
+render_cache = RenderCache(maxsize=1024, max_bytes=64 * 1024 * 1024, max_item_bytes=256 * 1024)
+
 # Create FastAPI app with CORS enabled
 app = FastAPI(
     title="QR Code Generator API",
     description="API for generating QR codes with various options",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 # Add CORS middleware
@@ -57,6 +139,8 @@ async def startup_event():
     """Log important information on startup"""
     logger.info("Starting up QR Code Generator API")
     logger.info(f"Python version: {sys.version}")
+    # Pillow-SIMD builds carry a .postN suffix
+    logger.info(f"Pillow version: {Image.__version__}")
     logger.info(f"Data directory: {data_dir}")
     # Test write permissions
     try:
@@ -66,6 +150,68 @@ async def startup_event():
         logger.info("Successfully verified write permissions to log directory")
     except Exception as e:
         logger.error(f"Failed to write to log directory: {e}")
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.error(f"Failed to create disk cache directory: {e}")
+    app.state.cache_trim_task = asyncio.create_task(trim_disk_cache_periodically())
+    # Render one QR code up front, then re-check in the background, so /health never renders
+    app.state.qr_ok = None  # unknown until the first check
+    await check_qr_generation()
+    app.state.qr_check_task = asyncio.create_task(check_qr_generation_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background work, the render worker processes and flush queued log records"""
+    app.state.cache_trim_task.cancel()
+    app.state.qr_check_task.cancel()
+    executor.shutdown(wait=True)
+    log_listener.stop()
+
+async def check_qr_generation():
+    """Render a test QR code through the worker pool and record the result for /health"""
+    try:
+        await _run_in_executor(_render_qr, "health check", "png", 10, 4, "black", "white", 1, "L")
+    except Exception as e:
+        if app.state.qr_ok is not False:
+            logger.error(f"Failed to generate test QR code: {e}")
+        app.state.qr_ok = False
+        return
+    if app.state.qr_ok is not True:
+        logger.info("Successfully verified QR code generation")
+    app.state.qr_ok = True
+
+async def check_qr_generation_periodically():
+    """Keep the /health QR generation status current without rendering on each probe"""
+    while True:
+        await asyncio.sleep(QR_CHECK_INTERVAL)
+        await check_qr_generation()
+
+def _trim_disk_cache(max_bytes: int):
+    """Delete the least recently used disk cache files until the cache fits in max_bytes"""
+    entries = []
+    for path in cache_dir.iterdir():
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        # Hits bump atime (see _touch_disk_cache) while mtime stays the Last-Modified date
+        entries.append((st.st_atime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+async def trim_disk_cache_periodically():
+    """Keep the disk cache bounded in the background"""
+    while True:
+        await asyncio.sleep(DISK_CACHE_TRIM_INTERVAL)
+        try:
+            await asyncio.to_thread(_trim_disk_cache, DISK_CACHE_MAX_BYTES)
+        except OSError as e:
+            logger.warning(f"Failed to trim disk cache: {e}")
 
 @app.get("/")
 async def root():
@@ -79,7 +225,12 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint with detailed status"""
-    return {"status": "healthy"}
+    if not app.state.qr_ok:
+        return ORJSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "unhealthy", "qr_generation": False},
+        )
+    return {"status": "healthy", "qr_generation": True, "render_cache": render_cache.cache_info()}
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -91,28 +242,70 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"detail": str(exc)}
     )
 
-SUPPORTED_FORMATS = {"png", "svg", "jpeg"}
+class ImageFormat(str, Enum):
+    png = "png"
+    svg = "svg"
+    jpeg = "jpeg"
+
+    @classmethod
+    def _missing_(cls, value):
+        # Accept any casing, e.g. "PNG"
+        if isinstance(value, str):
+            return cls._value2member_map_.get(value.lower())
+        return None
+
+class ArtisticImageFormat(str, Enum):
+    png = "png"
+    svg = "svg"
+
+    @classmethod
+    def _missing_(cls, value):
+        # Accept any casing, e.g. "SVG"
+        if isinstance(value, str):
+            return cls._value2member_map_.get(value.lower())
+        return None
 
 class QRRequest(BaseModel):
     data: str
-    box_size: Optional[int] = 10
-    border: Optional[int] = 4
+    box_size: int = 10
+    border: int = 4
     fill_color: Optional[str] = "black"
     back_color: Optional[str] = "white"
     version: Optional[int] = 1
     error_correction: Optional[str] = "L"  # L, M, Q, H
-    format: Optional[str] = "png"  # png, svg, jpeg
+    format: ImageFormat = ImageFormat.png  # png, svg, jpeg
     filename: Optional[str] = None  # Optional filename for download
     base64: Optional[bool] = False  # Return as base64 string in JSON
 
+# Error correction levels as understood by segno
 ERROR_CORRECTION_MAP = {
-    "L": qrcode.constants.ERROR_CORRECT_L,
-    "M": qrcode.constants.ERROR_CORRECT_M,
-    "Q": qrcode.constants.ERROR_CORRECT_Q,
-    "H": qrcode.constants.ERROR_CORRECT_H,
+    "L": "l",
+    "M": "m",
+    "Q": "q",
+    "H": "h",
+}
+
+# Accept either case without normalizing on every request
+ERROR_CORRECTION_LOOKUP = {
+    **ERROR_CORRECTION_MAP,
+    **{level.lower(): value for level, value in ERROR_CORRECTION_MAP.items()},
 }
 
 EXT_MAP = {"png": ".png", "svg": ".svg", "jpeg": ".jpg"}
+CONTENT_DISPOSITION_TEMPLATE = 'attachment; filename="{}"'
+BATCH_ZIP_HEADERS = {"Content-Disposition": "attachment; filename=qr_codes.zip"}
+MEDIA_TYPE_MAP = {"png": "image/png", "svg": "image/svg+xml", "jpeg": "image/jpeg"}
+
+# Larger logos are rejected before being read into memory and sent to a render worker
+MAX_LOGO_BYTES = 5 * 1024 * 1024
+
+# Matches Pillow's default JPEG quality
+JPEG_QUALITY = 75
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# QR codes are mostly flat runs of two colors, so fast deflate is nearly as small as the default
+PNG_COMPRESS_LEVEL = 1
 
 class BatchQRRequest(BaseModel):
     items: List[QRRequest]
@@ -124,7 +317,7 @@ class ArtisticQRRequest(BaseModel):
     border: Optional[int] = 4
     scale: Optional[int] = 10
     error_correction: Optional[str] = "L"
-    format: Optional[str] = "png"
+    format: ArtisticImageFormat = ArtisticImageFormat.png
 
 @app.exception_handler(HTTPException)
 def http_exception_handler(request: Request, exc: HTTPException):
@@ -134,231 +327,474 @@ def http_exception_handler(request: Request, exc: HTTPException):
 def validation_exception_handler(request: Request, exc: RequestValidationError):
     return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"error": exc.errors()})
 
-@app.get("/generate")
-def generate_qr(
-    data: str = Query(..., description="The data to encode in the QR code"),
-    format: str = Query("png", description="Image format: png, svg, or jpeg"),
-    filename: Optional[str] = Query(None, description="Optional filename for download"),
-    base64_: bool = Query(False, alias="base64", description="Return as base64 string in JSON")
-):
-    fmt = format.lower()
-    if not data:
-        raise HTTPException(status_code=400, detail="'data' parameter must not be empty.")
-    if fmt not in SUPPORTED_FORMATS:
-        raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}'. Supported formats: {', '.join(SUPPORTED_FORMATS)}.")
+class InvalidLogoError(ValueError):
+    """Raised when the uploaded logo cannot be decoded"""
+
+def _encode_jpeg(img: Image.Image):
+    """Encode a PIL image as JPEG with libjpeg-turbo"""
+    return simplejpeg.encode_jpeg(np.asarray(img.convert("RGB")), quality=JPEG_QUALITY, colorspace="RGB",
+                                 colorsubsampling="420")
+
+# The matrix doesn't depend on scale, colors or format, so reuse it across render styles
+@lru_cache(maxsize=512)
+def _make_qr(data: str, error: str, version: Optional[int]):
+    """Build a segno QR code, treating `version` as a minimum like qrcode's fit=True"""
+    try:
+        return segno.make_qr(data, error=error, version=version, boost_error=False)
+    except segno.DataOverflowError:
+        if version is None:
+            raise
+        return segno.make_qr(data, error=error, boost_error=False)
+
+def _segno_color(color: Optional[str]):
+    """Convert a Pillow color string to a segno color, so the same colors as qrcode/PIL are accepted"""
+    if color is None or color.lower() == "transparent":
+        return None
+    return ImageColor.getrgb(color)
+
+def _render_qr(data: str, fmt: str, box_size: int, border: int, fill_color: str,
+               back_color: str, version: Optional[int], error_correction: str):
+    """Render a QR code and return (content, media_type)"""
+    qr = _make_qr(data, ERROR_CORRECTION_LOOKUP.get(error_correction, "l"), version)
+    fill_color, back_color = _segno_color(fill_color), _segno_color(back_color)
+    buf = io.BytesIO()
+    if fmt == "svg":
+        qr.save(buf, kind="svg", scale=box_size, border=border, dark=fill_color, light=back_color)
+        media_type = "image/svg+xml"
+    elif fmt == "jpeg":
+        qr.save(buf, kind="png", scale=box_size, border=border, dark=fill_color, light=back_color,
+                compresslevel=PNG_COMPRESS_LEVEL)
+        buf.seek(0)
+        return _encode_jpeg(Image.open(buf)), "image/jpeg"
+    else:
+        qr.save(buf, kind="png", scale=box_size, border=border, dark=fill_color, light=back_color,
+                compresslevel=PNG_COMPRESS_LEVEL)
+        media_type = "image/png"
+    return buf.getvalue(), media_type
+
+def _render_batch_items(jobs: List[tuple]):
+    """Render a list of _render_qr argument tuples, returning None for any that cannot be encoded"""
+    results = []
+    for args in jobs:
+        try:
+            results.append(_render_qr(*args))
+        except Exception:
+            # Skip the item rather than cutting short an archive whose headers are already sent
+            results.append(None)
+    return results
+
+def _decode_logo(logo_bytes: bytes):
+    """Decode an uploaded logo into an RGBA array"""
+    if not logo_bytes:
+        raise InvalidLogoError("Invalid logo image file.")
+    arr = cv2.imdecode(np.frombuffer(logo_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+    if arr is not None and arr.dtype == np.uint16:
+        arr = (arr >> 8).astype(np.uint8)
+    if arr is None or arr.dtype != np.uint8:
+        # OpenCV can't read every format Pillow can (e.g. GIF), so fall back to it
+        try:
+            return np.asarray(Image.open(io.BytesIO(logo_bytes)).convert("RGBA"))
+        except Exception:
+            raise InvalidLogoError("Invalid logo image file.")
+    if arr.ndim == 2:
+        return cv2.cvtColor(arr, cv2.COLOR_GRAY2RGBA)
+    if arr.shape[2] == 3:
+        return cv2.cvtColor(arr, cv2.COLOR_BGR2RGBA)
+    return cv2.cvtColor(arr, cv2.COLOR_BGRA2RGBA)
+
+def _resize_logo(arr, size: int):
+    """Resize an RGBA logo with premultiplied alpha so fully transparent pixels don't bleed into edges"""
+    rgba = arr.astype(np.float32)
+    rgba[..., :3] *= rgba[..., 3:4] / 255.0
+    rgba = cv2.resize(rgba, (size, size), interpolation=cv2.INTER_LANCZOS4)
+    alpha = np.clip(rgba[..., 3:4], 0, 255)
+    rgb = np.divide(rgba[..., :3] * 255.0, alpha, out=np.zeros_like(rgba[..., :3]), where=alpha > 0)
+    return np.concatenate([np.clip(rgb, 0, 255), alpha], axis=2).round().astype(np.uint8)
+
+# Per render worker; keyed on the upload's digest so the raw bytes aren't kept alive
+logo_cache = RenderCache(maxsize=64, max_bytes=64 * 1024 * 1024, max_item_bytes=8 * 1024 * 1024)
+
+def _load_logo(logo_digest: str, size: int, logo_bytes: bytes):
+    """Decode and resize a logo to a size x size RGBA array, cached on (digest, size)"""
+    key = (logo_digest, size)
+    arr = logo_cache.get(key)
+    if arr is None:
+        arr = _resize_logo(_decode_logo(logo_bytes), size)
+        arr.flags.writeable = False  # shared between requests through the cache
+        logo_cache.put(key, arr, arr.nbytes)
+    return arr
+
+def _render_qr_with_logo(data: str, fmt: str, box_size: int, border: int, fill_color: str,
+                         back_color: str, version: int, logo_bytes: Optional[bytes],
+                         logo_digest: Optional[str]):
+    """Render a high error correction QR code with an optional centered logo"""
     qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+        version=version,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=box_size,
+        border=border,
     )
     qr.add_data(data)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
     buf = io.BytesIO()
     if fmt == "svg":
-        from qrcode.image.svg import SvgImage
-        img = qrcode.make(data, image_factory=SvgImage)
-        img.save(buf)
+        # SVG output has no logo overlay, so write the already built matrix and skip rasterizing
+        qr.make_image(image_factory=SvgImage).save(buf)
+        return buf.getvalue(), "image/svg+xml"
+    img = qr.make_image(fill_color=fill_color, back_color=back_color).convert("RGBA")
+    # Overlay logo if provided
+    if logo_bytes is not None:
+        # Resize logo (smaller for better scan reliability)
+        qr_width, qr_height = img.size
+        factor = 6  # logo covers 1/6 of QR code
+        logo_size = min(qr_width, qr_height) // factor
+        logo_arr = _load_logo(logo_digest, logo_size, logo_bytes)
+        # Calculate position and alpha-blend the logo over that region
+        x, y = (qr_width - logo_size) // 2, (qr_height - logo_size) // 2
+        qr_arr = np.array(img)
+        region = qr_arr[y:y + logo_size, x:x + logo_size]
+        alpha = logo_arr[..., 3:4].astype(np.uint16)
+        region[:] = (logo_arr * alpha + region * (255 - alpha) + 127) // 255
+        img = Image.fromarray(qr_arr, "RGBA")
+    if fmt == "jpeg":
+        return _encode_jpeg(img), "image/jpeg"
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    return buf.getvalue(), "image/png"
+
+def _render_artistic_qr(data: str, fmt: str, scale: int, border: int, dark: str, light: str,
+                        error_correction: str):
+    """Render an artistic QR code with segno and return (content, media_type)"""
+    qr = segno.make(data, error=error_correction)  # segno accepts either case
+    buf = io.BytesIO()
+    if fmt == "svg":
+        qr.save(buf, kind="svg", scale=scale, border=border, dark=dark, light=light)
         media_type = "image/svg+xml"
-    elif fmt == "jpeg":
-        img = img.convert("RGB")
-        img.save(buf, format="JPEG")
-        media_type = "image/jpeg"
     else:
-        img.save(buf, format="PNG")
+        qr.save(buf, kind="png", scale=scale, border=border, dark=dark, light=light)
         media_type = "image/png"
-    buf.seek(0)
-    content = buf.read()
+    return buf.getvalue(), media_type
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Unseekable sink for zipfile that hands written bytes back out in chunks"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+async def _stream_zip(tasks):
+    """Yield a ZIP archive incrementally as each batch chunk finishes rendering"""
+    sink = _ZipStreamBuffer()
+    try:
+        # PNG/JPEG are already compressed, so only SVG text is worth deflating
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as zf:
+            for task in tasks:
+                try:
+                    results = await task
+                except Exception as e:
+                    # The 200 headers are already sent, so skip this chunk rather than truncate the archive
+                    logger.error(f"Failed to render batch chunk: {e}")
+                    continue
+                for filename, content in results:
+                    compress_type = zipfile.ZIP_DEFLATED if filename.endswith(".svg") else zipfile.ZIP_STORED
+                    zf.writestr(filename, content, compress_type=compress_type)
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        # Don't keep rendering for a client that went away
+        for task in tasks:
+            task.cancel()
+
+def _download_name(filename: str, fmt: str):
+    """Add the format's extension to a filename if it is missing"""
+    ext = EXT_MAP[fmt]
+    return filename if filename.endswith(ext) else filename + ext
+
+def _content_disposition(filename: str, fmt: str):
+    """Build an attachment header for a download of the given format"""
+    return CONTENT_DISPOSITION_TEMPLATE.format(_download_name(filename, fmt))
+
+def _make_etag(*parts):
+    """Build a strong ETag from the parameters that determine a response"""
+    # repr() of the tuple keeps part boundaries, so different parameters can't share a key
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str):
+    """Check an If-None-Match header value against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+async def _read_logo(logo: UploadFile):
+    """Read an uploaded logo, rejecting it if it exceeds MAX_LOGO_BYTES"""
+    # The multipart parser has already spooled the upload, so check its size before reading it into memory
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Logo image must not exceed {MAX_LOGO_BYTES // (1024 * 1024)} MB.",
+    )
+    if logo.size is not None and logo.size > MAX_LOGO_BYTES:
+        raise too_large
+    logo_bytes = await logo.read()
+    if len(logo_bytes) > MAX_LOGO_BYTES:
+        raise too_large
+    return logo_bytes
+
+def _not_modified_since(if_modified_since: Optional[str], mtime: float):
+    """Check an If-Modified-Since header value against a file modification time"""
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) <= since.timestamp()
+
+def _disk_cache_path(data: str, fmt: str):
+    """Path of the disk cache entry for a GET /generate render"""
+    key = hashlib.blake2b(f"{data}|{fmt}".encode("utf-8"), digest_size=16).hexdigest()
+    return cache_dir / f"{key}{EXT_MAP[fmt]}"
+
+def _write_disk_cache(path: Path, content: bytes):
+    """Atomically write a rendered payload into the disk cache"""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _touch_disk_cache(path: Path, mtime: float):
+    """Record a disk cache hit for LRU trimming without changing Last-Modified"""
+    try:
+        os.utime(path, (time.time(), mtime))
+    except OSError:
+        pass
+
+def _read_disk_cache(path: Path, mtime: float):
+    """Read a disk cache entry and mark it as recently used"""
+    content = path.read_bytes()
+    _touch_disk_cache(path, mtime)
+    return content
+
+def _replace_broken_executor(broken: ProcessPoolExecutor):
+    """Swap a broken process pool for a fresh one, unless another request already did"""
+    global executor
+    # No await between the check and the swap, so concurrent requests can't both replace it
+    if executor is broken:
+        logger.error("Render worker pool is broken, starting a new one")
+        executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+        broken.shutdown(wait=False, cancel_futures=True)
+
+async def _run_in_executor(func, *args):
+    """Run a CPU-bound render function in the process pool without blocking the event loop"""
+    # A worker that dies (e.g. OOM-killed) breaks the whole pool, so replace it and retry once
+    for _ in range(2):
+        pool = executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            _replace_broken_executor(pool)
+    app.state.qr_ok = False  # reported by /health until the background check succeeds again
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="QR code rendering is temporarily unavailable, please retry.",
+    )
+
+async def _render_cached(func, *args, key=None):
+    """Render through the process pool, serving repeated requests from the render cache"""
+    if key is None:
+        key = (func, *args)
+    result = render_cache.get(key)
+    if result is None:
+        result = await _run_in_executor(func, *args)
+        render_cache.put(key, result, len(result[0]))
+    return result
+
+async def _render_batch_chunk(chunk: List[tuple]):
+    """Render a chunk of (filename, args) batch jobs, only sending cache misses to the pool"""
+    rendered = [render_cache.get((_render_qr, *args)) for _, args in chunk]
+    misses = [args for (_, args), result in zip(chunk, rendered) if result is None]
+    if misses:
+        fresh = iter(await _run_in_executor(_render_batch_items, misses))
+        for idx, (_, args) in enumerate(chunk):
+            if rendered[idx] is None:
+                rendered[idx] = next(fresh)
+                if rendered[idx] is not None:
+                    render_cache.put((_render_qr, *args), rendered[idx], len(rendered[idx][0]))
+    return [(filename, result[0]) for (filename, _), result in zip(chunk, rendered) if result is not None]
+
+@app.get("/generate")
+async def generate_qr(
+    data: str = Query(..., description="The data to encode in the QR code"),
+    format: ImageFormat = Query(ImageFormat.png, description="Image format: png, svg, or jpeg"),
+    filename: Optional[str] = Query(None, description="Optional filename for download"),
+    base64_: bool = Query(False, alias="base64", description="Return as base64 string in JSON"),
+    if_none_match: Optional[str] = Header(None, description="ETag from a previous response"),
+    if_modified_since: Optional[str] = Header(None, description="Last-Modified from a previous response")
+):
+    fmt = format.value
+    if not data:
+        raise HTTPException(status_code=400, detail="'data' parameter must not be empty.")
+    # The response is a pure function of the query, so clients can revalidate without a re-render
+    etag = _make_etag(data, fmt, filename, base64_)
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # Serve from the disk cache so repeated requests survive restarts
+    media_type = MEDIA_TYPE_MAP[fmt]
+    cache_path = _disk_cache_path(data, fmt)
+    content = None
+    try:
+        mtime = os.stat(cache_path).st_mtime
+        headers["Last-Modified"] = formatdate(mtime, usegmt=True)
+        if if_none_match is None and _not_modified_since(if_modified_since, mtime):
+            await asyncio.to_thread(_touch_disk_cache, cache_path, mtime)
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        content = await asyncio.to_thread(_read_disk_cache, cache_path, mtime)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # A broken cache entry should cost a re-render, not a 500
+        logger.warning(f"Failed to read QR code from disk cache: {e}")
+    if content is None:
+        try:
+            content, media_type = await _render_cached(_render_qr, data, fmt, 10, 4, "black", "white", 1, "L")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Failed to generate QR code: {str(e)}")
+        try:
+            await asyncio.to_thread(_write_disk_cache, cache_path, content)
+            mtime = os.stat(cache_path).st_mtime
+        except OSError as e:
+            logger.warning(f"Failed to write QR code to disk cache: {e}")
+            mtime = time.time()
+        headers["Last-Modified"] = formatdate(mtime, usegmt=True)
     if base64_:
-        b64str = base64.b64encode(content).decode("utf-8")
-        return JSONResponse(content={"base64": b64str, "content_type": media_type})
-    headers = {}
+        b64str = pybase64.b64encode_as_string(content)
+        return ORJSONResponse(content={"base64": b64str, "content_type": media_type}, headers=headers)
     if filename:
-        ext = EXT_MAP.get(fmt, ".png")
-        download_name = filename if filename.endswith(ext) else filename + ext
-        headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        headers["Content-Disposition"] = _content_disposition(filename, fmt)
     return Response(content=content, media_type=media_type, headers=headers)
 
 @app.post("/generate")
-def generate_qr_post(req: QRRequest):
-    fmt = (req.format or "png").lower()
+async def generate_qr_post(req: QRRequest):
+    fmt = req.format.value
     if not req.data:
         raise HTTPException(status_code=400, detail="'data' field must not be empty.")
-    if fmt not in SUPPORTED_FORMATS:
-        raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}'. Supported formats: {', '.join(SUPPORTED_FORMATS)}.")
-    error_correction = ERROR_CORRECTION_MAP.get(req.error_correction.upper(), qrcode.constants.ERROR_CORRECT_L)
-    qr = qrcode.QRCode(
-        version=req.version,
-        error_correction=error_correction,
-        box_size=req.box_size,
-        border=req.border,
-    )
-    qr.add_data(req.data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color=req.fill_color, back_color=req.back_color)
-    buf = io.BytesIO()
-    if fmt == "svg":
-        from qrcode.image.svg import SvgImage
-        img = qrcode.make(req.data, image_factory=SvgImage)
-        img.save(buf)
-        media_type = "image/svg+xml"
-    elif fmt == "jpeg":
-        img = img.convert("RGB")
-        img.save(buf, format="JPEG")
-        media_type = "image/jpeg"
-    else:
-        img.save(buf, format="PNG")
-        media_type = "image/png"
-    buf.seek(0)
-    content = buf.read()
+    try:
+        content, media_type = await _render_cached(
+            _render_qr, req.data, fmt, req.box_size, req.border, req.fill_color, req.back_color,
+            req.version, req.error_correction or "L",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Failed to generate QR code: {str(e)}")
     if req.base64:
-        b64str = base64.b64encode(content).decode("utf-8")
-        return JSONResponse(content={"base64": b64str, "content_type": media_type})
+        b64str = pybase64.b64encode_as_string(content)
+        return ORJSONResponse(content={"base64": b64str, "content_type": media_type})
     headers = {}
     if req.filename:
-        ext = EXT_MAP.get(fmt, ".png")
-        download_name = req.filename if req.filename.endswith(ext) else req.filename + ext
-        headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        headers["Content-Disposition"] = _content_disposition(req.filename, fmt)
     return Response(content=content, media_type=media_type, headers=headers)
 
 @app.post("/batch_generate")
-def batch_generate(req: BatchQRRequest):
+async def batch_generate(req: BatchQRRequest):
     if not req.items or not isinstance(req.items, list):
         raise HTTPException(status_code=400, detail="'items' must be a non-empty list of QR code requests.")
-    in_memory_zip = io.BytesIO()
-    with zipfile.ZipFile(in_memory_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for idx, item in enumerate(req.items):
-            fmt = (item.format or "png").lower()
-            if not item.data:
-                continue  # skip empty data
-            if fmt not in SUPPORTED_FORMATS:
-                continue  # skip unsupported formats
-            error_correction = ERROR_CORRECTION_MAP.get((item.error_correction or "L").upper(), qrcode.constants.ERROR_CORRECT_L)
-            qr = qrcode.QRCode(
-                version=item.version,
-                error_correction=error_correction,
-                box_size=item.box_size,
-                border=item.border,
-            )
-            qr.add_data(item.data)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color=item.fill_color, back_color=item.back_color)
-            buf = io.BytesIO()
-            if fmt == "svg":
-                from qrcode.image.svg import SvgImage
-                img = qrcode.make(item.data, image_factory=SvgImage)
-                img.save(buf)
-                ext = ".svg"
-            elif fmt == "jpeg":
-                img = img.convert("RGB")
-                img.save(buf, format="JPEG")
-                ext = ".jpg"
-            else:
-                img.save(buf, format="PNG")
-                ext = ".png"
-            buf.seek(0)
-            # Determine filename
-            if item.filename:
-                filename = item.filename if item.filename.endswith(ext) else item.filename + ext
-            else:
-                filename = f"qr_{idx+1}{ext}"
-            zf.writestr(filename, buf.read())
-    in_memory_zip.seek(0)
-    return Response(
-        content=in_memory_zip.read(),
+    jobs = []
+    for idx, item in enumerate(req.items):
+        fmt = item.format.value
+        if not item.data:
+            continue  # skip empty data
+        # Determine filename
+        filename = _download_name(item.filename or f"qr_{idx+1}", fmt)
+        jobs.append((filename, (
+            item.data, fmt, item.box_size, item.border, item.fill_color, item.back_color,
+            item.version, item.error_correction or "L",
+        )))
+    # Fan the items out across the worker processes in chunks to limit IPC overhead
+    chunksize = max(1, len(jobs) // (os.cpu_count() or 1))
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+    tasks = [asyncio.ensure_future(_render_batch_chunk(chunk)) for chunk in chunks]
+    # Wait for the first chunk so pool failures still surface as an error status, not a truncated 200
+    if tasks:
+        try:
+            await tasks[0]
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    return StreamingResponse(
+        _stream_zip(tasks),
         media_type="application/zip",
-        headers={"Content-Disposition": "attachment; filename=qr_codes.zip"}
+        headers=BATCH_ZIP_HEADERS
     )
 
 @app.post("/generate_with_logo")
-def generate_qr_with_logo(
+async def generate_qr_with_logo(
     data: str = Form(...),
     box_size: int = Form(10),
     border: int = Form(4),
     fill_color: str = Form("black"),
     back_color: str = Form("white"),
     version: int = Form(1),
-    format: str = Form("png"),
+    format: ImageFormat = Form(ImageFormat.png),
     filename: str = Form(None),
     base64_: bool = Form(False),
     logo: UploadFile = File(None)
 ):
-    fmt = (format or "png").lower()
+    fmt = format.value
     if not data:
         raise HTTPException(status_code=400, detail="'data' field must not be empty.")
-    if fmt not in SUPPORTED_FORMATS:
-        raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}'. Supported formats: {', '.join(SUPPORTED_FORMATS)}.")
-    error_correction_val = ERROR_CORRECTION_MAP.get('H', qrcode.constants.ERROR_CORRECT_H)
-    qr = qrcode.QRCode(
-        version=version,
-        error_correction=error_correction_val,
-        box_size=box_size,
-        border=border,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color=fill_color, back_color=back_color).convert("RGBA")
-    # Overlay logo if provided
-    if logo is not None:
-        try:
-            logo_bytes = logo.file.read()
-            logo_img = Image.open(io.BytesIO(logo_bytes)).convert("RGBA")
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid logo image file.")
-        # Resize logo (smaller for better scan reliability)
-        qr_width, qr_height = img.size
-        factor = 6  # logo covers 1/6 of QR code
-        logo_size = min(qr_width, qr_height) // factor
-        logo_img = logo_img.resize((logo_size, logo_size), Image.LANCZOS)
-        # Calculate position and paste
-        pos = ((qr_width - logo_size) // 2, (qr_height - logo_size) // 2)
-        img.paste(logo_img, pos, mask=logo_img)
-    buf = io.BytesIO()
-    if fmt == "svg":
-        from qrcode.image.svg import SvgImage
-        img_svg = qrcode.make(data, image_factory=SvgImage)
-        img_svg.save(buf)
-        media_type = "image/svg+xml"
-    elif fmt == "jpeg":
-        img = img.convert("RGB")
-        img.save(buf, format="JPEG")
-        media_type = "image/jpeg"
-    else:
-        img.save(buf, format="PNG")
-        media_type = "image/png"
-    buf.seek(0)
-    content = buf.read()
+    logo_bytes = await _read_logo(logo) if logo is not None else None
+    try:
+        # Key the cache on a digest of the logo rather than holding the upload itself
+        logo_digest = hashlib.blake2b(logo_bytes).hexdigest() if logo_bytes is not None else None
+        content, media_type = await _render_cached(
+            _render_qr_with_logo, data, fmt, box_size, border, fill_color, back_color, version, logo_bytes,
+            logo_digest, key=(_render_qr_with_logo, data, fmt, box_size, border, fill_color, back_color, version, logo_digest),
+        )
+    except InvalidLogoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if base64_:
-        b64str = base64.b64encode(content).decode("utf-8")
-        return JSONResponse(content={"base64": b64str, "content_type": media_type})
+        b64str = pybase64.b64encode_as_string(content)
+        return ORJSONResponse(content={"base64": b64str, "content_type": media_type})
     headers = {}
     if filename:
-        ext = EXT_MAP.get(fmt, ".png")
-        download_name = filename if filename.endswith(ext) else filename + ext
-        headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        headers["Content-Disposition"] = _content_disposition(filename, fmt)
     return Response(content=content, media_type=media_type, headers=headers)
 
 @app.post("/generate_artistic")
-def generate_artistic_qr(req: ArtisticQRRequest):
-    fmt = req.format.lower()
+async def generate_artistic_qr(req: ArtisticQRRequest):
+    fmt = req.format.value
     if not req.data:
         raise HTTPException(status_code=400, detail="'data' field must not be empty.")
-    if fmt not in ["png", "svg"]:
-        raise HTTPException(status_code=400, detail="Only PNG and SVG formats are supported for artistic QR codes.")
     try:
-        qr = segno.make(req.data, error=req.error_correction.upper())
-    except Exception as e:
+        content, media_type = await _render_cached(
+            _render_artistic_qr, req.data, fmt, req.scale, req.border, req.dark, req.light, req.error_correction,
+        )
+    except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Failed to generate QR code: {str(e)}")
-    buf = io.BytesIO()
-    if fmt == "svg":
-        qr.save(buf, kind="svg", scale=req.scale, border=req.border, dark=req.dark, light=req.light)
-        media_type = "image/svg+xml"
-    else:
-        qr.save(buf, kind="png", scale=req.scale, border=req.border, dark=req.dark, light=req.light)
-        media_type = "image/png"
-    buf.seek(0)
-    return Response(content=buf.read(), media_type=media_type)
+    return Response(content=content, media_type=media_type)
 
 def main():
-    pass 
\ No newline at end of file
+    pass
\ No newline at end of file